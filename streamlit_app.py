@@ -1,51 +1,268 @@
 import streamlit as st
 import time
+import io
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from supabase import create_client, Client
+from supabase import create_client, Client, PostgrestAPIError
 
-# Load data from Supabase
-@st.cache_data(ttl=10)
-def load_data():
+# Only the columns the dashboard renders are fetched; the Raw Data table and CSV export
+# show this same set, so other table columns (head_direction, head_tilt, ...) are not included
+COLUMNS = ['timestamp', 'latitude', 'longitude', 'speed', 'fuel_level', 'engine_temp',
+           'accelerometer_x', 'accelerometer_y', 'accelerometer_z', 'eye_closed_duration',
+           'driver_state', 'vehicle_health', 'vehicle_type']
+# Extra columns fetched when the driver risk metrics are enabled
+RISK_COLUMNS = ['trip_id', 'speeding_flag', 'harsh_braking', 'engine_overheat', 'fatigue_score']
+NUMERIC_COLS = ['latitude', 'longitude', 'speed', 'fuel_level', 'engine_temp',
+                'accelerometer_x', 'accelerometer_y', 'accelerometer_z',
+                'eye_closed_duration', 'fatigue_score']
+FLAG_COLS = ['speeding_flag', 'harsh_braking', 'engine_overheat']
+CATEGORICAL_COLS = ['driver_state', 'vehicle_health', 'vehicle_type', 'trip_id']
+# Most recent rows loaded, fetched in pages no larger than PostgREST's max-rows
+ROW_LIMIT_OPTIONS = [500, 1000, 5000, 10000]
+ROW_LIMIT = 1000
+PAGE_SIZE = 1000
+# Map points are binned to a lat/lon grid of this many decimals (~100 m cells)
+MAP_GRID_DECIMALS = 3
+# st.map's default marker radius in meters, used for a cell holding a single sample
+MAP_POINT_RADIUS = 100
+# Rows shown in the raw data table; the full selection is available as a CSV download
+RAW_ROWS = 200
+# Upper bound on points drawn per line trace
+MAX_POINTS = 2000
+
+# Supabase client, created once per process
+@st.cache_resource
+def get_client() -> Client:
     url = st.secrets["supabase"]["url"]
     key = st.secrets["supabase"]["key"]
-    supabase: Client = create_client(url, key)
+    return create_client(url, key)
 
-    response = supabase.table("telematics") \
-        .select("*") \
-        .order("timestamp", desc=True) \
-        .limit(1000) \
-        .execute()
+# Fetch the latest `limit` rows page by page so the server-side row cap can't truncate them.
+# Later pages are pinned to the newest timestamp of the first one, so rows inserted while
+# paging don't shift the offsets.
+def fetch_rows(supabase, limit, columns, page_size=PAGE_SIZE):
+    pages = []
+    fetched = 0
+    newest = None
+    while fetched < limit:
+        query = supabase.table("telematics") \
+            .select(",".join(columns)) \
+            .order("timestamp", desc=True)
+        if newest is not None:
+            query = query.lte("timestamp", newest)
+        response = query.range(fetched, min(fetched + page_size, limit) - 1).csv().execute()
+        if not response.data:
+            break
+        # PostgREST returns CSV text, parsed without building per-row dicts
+        page = pd.read_csv(io.StringIO(response.data))
+        if page.empty:
+            break
+        pages.append(page)
+        # The server may return fewer rows than asked for (max-rows); continue from what arrived
+        fetched += len(page)
+        if newest is None:
+            newest = page['timestamp'].iloc[0]
+    if not pages:
+        return pd.DataFrame(columns=list(columns))
+    return pd.concat(pages, ignore_index=True)
 
-    df = pd.DataFrame(response.data)
-    df = df.sort_values("timestamp")
+# Load data from Supabase
+@st.cache_data(ttl=10)
+def load_data(limit=ROW_LIMIT, columns=tuple(COLUMNS)):
+    df = fetch_rows(get_client(), limit, columns)
+    if df.empty:
+        return df
+    # Rows arrive newest-first from the server-side ORDER BY; reversing is enough
+    df = df.iloc[::-1].reset_index(drop=True)
 
     # Clean and process data
-    df['timestamp'] = pd.to_datetime(df['timestamp'], format='ISO8601', errors='coerce')
-    numeric_cols = ['latitude', 'longitude', 'speed', 'fuel_level', 'engine_temp',
-                    'accelerometer_x', 'accelerometer_y', 'accelerometer_z',
-                    'head_direction', 'head_tilt', 'eye_closed_duration']
-    for col in numeric_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
-    categorical_cols = ['driver_state', 'vehicle_health', 'vehicle_type']
-    for col in categorical_cols:
-        df[col] = df[col].astype(str).str.lower()
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='ISO8601', errors='coerce', utc=True)
+    # Coerced rather than parsed with a strict dtype so one bad reading becomes NaN instead of an error
+    numeric_cols = [col for col in NUMERIC_COLS if col in df.columns]
+    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce', downcast='float')
+    flag_cols = [col for col in FLAG_COLS if col in df.columns]
+    if flag_cols:
+        # Booleans arrive as text ('t'/'true'/'1'); store them as 0/1
+        df[flag_cols] = df[flag_cols].astype(str).apply(lambda col: col.str[:1].str.lower().isin(['t', '1'])).astype('int8')
+    categorical_cols = [col for col in CATEGORICAL_COLS if col in df.columns]
+    df[categorical_cols] = df[categorical_cols].astype(str).apply(lambda col: col.str.lower()).astype('category')
     df = df.dropna(subset=['timestamp', 'latitude', 'longitude'])
     return df
 
+# Cheap cache key for a loaded frame, used instead of hashing every row
+def fingerprint(data):
+    if data.empty:
+        return (0,)
+    return (len(data), tuple(data.columns), str(data['timestamp'].iloc[0]), str(data['timestamp'].iloc[-1]))
+
+# Cached results are keyed on (data fingerprint, selection); the frame itself is not hashed
+@st.cache_data(show_spinner=False, max_entries=64)
+def apply_filters(_data, data_key, vehicle_types):
+    vehicle_type = _data['vehicle_type'].cat
+    # One slot per category plus a trailing False for missing values (code -1)
+    allowed = np.append(vehicle_type.categories.isin(vehicle_types), False)
+    mask = allowed[vehicle_type.codes.to_numpy()]
+    return _data.iloc[np.flatnonzero(mask)]
+
+# Row count per category from the integer codes, most frequent first like value_counts();
+# categories absent from the slice are dropped
+def category_counts(series):
+    codes = series.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories))
+    order = np.argsort(-counts, kind='stable')
+    order = order[counts[order] > 0]
+    return pd.DataFrame({series.name: series.cat.categories[order], 'count': counts[order]})
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_state_bar(_data, filter_key):
+    driver_state_counts = category_counts(_data['driver_state'])
+    return px.bar(driver_state_counts, x='driver_state', y='count',
+                  title="Driver State Distribution",
+                  color='driver_state', color_discrete_sequence=px.colors.qualitative.Plotly)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_health_pie(_data, filter_key):
+    health_counts = category_counts(_data['vehicle_health'])
+    return px.pie(health_counts, names='vehicle_health', values='count',
+                  title="Vehicle Health Status")
+
+# High-acceleration and overheating counts from one pass over the float32 sensor block
+def threshold_counts(data):
+    sensors = data[['accelerometer_x', 'accelerometer_y', 'accelerometer_z', 'engine_temp']].to_numpy(dtype=np.float32)
+    high_accel = np.count_nonzero((np.abs(sensors[:, :3]) > 2.5).any(axis=1))
+    overheating = np.count_nonzero(sensors[:, 3] > 120)
+    return high_accel, overheating
+
+# One map marker per occupied grid cell; busier cells are drawn larger (up to the cell size) and more opaque
+def location_bins(data, decimals=MAP_GRID_DECIMALS):
+    points = data[['latitude', 'longitude']].dropna()
+    cells = [points['latitude'].round(decimals), points['longitude'].round(decimals)]
+    bins = points.groupby(cells).agg(latitude=('latitude', 'mean'), longitude=('longitude', 'mean'),
+                                     count=('latitude', 'size')).reset_index(drop=True)
+    cell_size = 111_320 * 10.0 ** -decimals
+    bins['radius'] = np.minimum(MAP_POINT_RADIUS * np.sqrt(bins['count']), max(cell_size, MAP_POINT_RADIUS))
+    density = np.log1p(bins['count']) / np.log1p(bins['count'].max()) if len(bins) else bins['count']
+    bins['color'] = [(200, 30, 0, int(alpha)) for alpha in 80 + 150 * density]
+    return bins
+
+# Largest-Triangle-Three-Buckets: pick n_out indices that keep the visual shape of y(x)
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < n_out - 1 else (n - 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+# Downsample one line to at most n_out points before plotting
+def downsample(data, y, n_out=MAX_POINTS):
+    data = data.dropna(subset=[y])
+    if len(data) <= n_out:
+        return data
+    x = data['timestamp'].to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(np.float64)
+    return data.iloc[lttb_indices(x, data[y].to_numpy(dtype=np.float64), n_out)]
+
+# WebGL line trace built straight from the column arrays
+def line_trace(data, y, name):
+    data = downsample(data, y)
+    # load_data normalises timestamps to UTC, so dropping the tz here keeps the same times as the
+    # Raw Data table and CSV export while giving Plotly a typed datetime64 array
+    return go.Scattergl(x=data['timestamp'].to_numpy(dtype='datetime64[ns]'), y=data[y].to_numpy(dtype=np.float32),
+                        mode='lines', name=str(name))
+
+# One trace per vehicle type, grouped once instead of through plotly express
+def vehicle_lines(data, y, title):
+    groups = data.groupby('vehicle_type', sort=False, observed=True)
+    fig = go.Figure([line_trace(group, y, vehicle_type) for vehicle_type, group in groups])
+    fig.update_layout(title=title, xaxis_title="Timestamp", yaxis_title=y.capitalize(),
+                      legend_title_text='vehicle_type')
+    return fig
+
+# Figure builders, cached on (data fingerprint, selection) like the count charts
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_metric_line(_data, filter_key, metric):
+    return vehicle_lines(_data, metric, f"{metric.capitalize()} Over Time")
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_eye_scatter(_data, filter_key):
+    fig = px.scatter(_data, x='eye_closed_duration', y='driver_state',
+                     color='driver_state', title="Eye Closed Duration vs Driver State",
+                     hover_data=['timestamp', 'vehicle_type'])
+    risky_df = _data[_data['eye_closed_duration'] > 2.5]
+    if not risky_df.empty:
+        fig.add_trace(go.Scatter(x=risky_df['eye_closed_duration'], y=risky_df['driver_state'],
+                                 mode='markers', marker=dict(color='red', size=10, symbol='x'),
+                                 name='Risky (>2.5s)'))
+    return fig, len(risky_df)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_temp_line(_data, filter_key):
+    fig = vehicle_lines(_data, 'engine_temp', "Engine Temperature Over Time")
+    fig.add_hline(y=120, line_dash="dash", line_color="red", annotation_text="Overheating Threshold (120°C)")
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_accel_line(_data, filter_key):
+    accel_cols = ['accelerometer_x', 'accelerometer_y', 'accelerometer_z']
+    fig = go.Figure([line_trace(_data, col, col) for col in accel_cols])
+    fig.update_layout(title="Accelerometer Readings Over Time", xaxis_title="Timestamp", yaxis_title="g")
+    fig.add_hline(y=2.5, line_dash="dash", line_color="orange", annotation_text="High Acceleration Threshold")
+    fig.add_hline(y=-2.5, line_dash="dash", line_color="orange")
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_fatigue_histogram(_data, filter_key, bins=20):
+    # Bin counts are computed here so only `bins` bars are sent to the browser
+    counts, edges = np.histogram(_data['fatigue_score'].dropna().to_numpy(dtype=np.float32), bins=bins)
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges)))
+    fig.update_layout(title="Fatigue Score Distribution", xaxis_title="Fatigue Score", yaxis_title="Count")
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def export_csv(_data, filter_key):
+    return _data.to_csv(index=False).encode()
+
 # Set page title and layout
 st.set_page_config(page_title="Telematics Dashboard", layout="wide")
 st.title("🚗 Telematics Dashboard")
 
+# Sidebar for data source options and filters
+st.sidebar.header("Data")
+row_limit = st.sidebar.selectbox("Rows to load", ROW_LIMIT_OPTIONS, index=ROW_LIMIT_OPTIONS.index(ROW_LIMIT))
+# A failed risk-column load switches the toggle back off (before it is drawn) instead of retrying every rerun
+if st.session_state.pop("risk_columns_missing", False):
+    st.session_state["show_risk"] = False
+    st.error("The telematics table has no driver risk columns; showing standard metrics only.")
+show_risk = st.sidebar.toggle("Driver risk metrics", value=False, key="show_risk",
+                              help="Requires trip_id, speeding_flag, harsh_braking, engine_overheat and fatigue_score columns.")
+
 # Load data
-df = load_data()
+if show_risk:
+    try:
+        df = load_data(row_limit, tuple(COLUMNS + RISK_COLUMNS))
+    except PostgrestAPIError:
+        # PostgREST rejects the select when the table lacks the extended schema
+        st.session_state["risk_columns_missing"] = True
+        st.rerun()
+else:
+    df = load_data(row_limit, tuple(COLUMNS))
 if df.empty:
     st.stop()
 
-# Sidebar for filters
 st.sidebar.header("Filters")
-vehicle_types = df['vehicle_type'].unique()
+vehicle_types = df['vehicle_type'].cat.categories.tolist()
 selected_vehicle_type = st.sidebar.multiselect("Select Vehicle Type", vehicle_types, default=vehicle_types)
 
 # Manual data refresh button
@@ -53,26 +270,47 @@ if st.sidebar.button("🔄 Refresh Now"):
     st.cache_data.clear()
     st.query_params.update({"refresh": str(time.time())})
 
-filtered_df = df[df['vehicle_type'].isin(selected_vehicle_type)]
+filter_key = (fingerprint(df), tuple(sorted(selected_vehicle_type)))
+filtered_df = apply_filters(df, *filter_key)
+high_accel_count, overheating_count = threshold_counts(filtered_df)
 
 
 # Overview Section
 st.header("Overview")
+overview = filtered_df[['speed', 'fuel_level']].mean()
 col1, col2, col3, col4 = st.columns(4)
 with col1:
     st.metric("Total Trips", len(filtered_df))
 with col2:
-    st.metric("Avg Speed (km/h)", f"{filtered_df['speed'].mean():.2f}")
+    st.metric("Avg Speed (km/h)", f"{overview['speed']:.2f}")
 with col3:
-    st.metric("Avg Fuel Level (%)", f"{filtered_df['fuel_level'].mean():.2f}")
+    st.metric("Avg Fuel Level (%)", f"{overview['fuel_level']:.2f}")
 with col4:
     drowsy_pct = (filtered_df['driver_state'] == 'drowsy').mean() * 100
     st.metric("Drowsy Drivers (%)", f"{drowsy_pct:.2f}")
 
+# Driver Risk Section
+if show_risk:
+    st.header("Driver Risk")
+    risk = filtered_df.agg({'trip_id': 'nunique', 'speeding_flag': 'sum', 'harsh_braking': 'sum',
+                            'engine_overheat': 'sum', 'fatigue_score': 'mean'})
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Unique Trips", int(risk['trip_id']))
+    with col2:
+        st.metric("Speeding Events", int(risk['speeding_flag']))
+    with col3:
+        st.metric("Harsh Braking Events", int(risk['harsh_braking']))
+    with col4:
+        st.metric("Avg Fatigue Score", f"{risk['fatigue_score']:.2f}")
+    fig_fatigue = build_fatigue_histogram(filtered_df, filter_key)
+    st.plotly_chart(fig_fatigue, use_container_width=True)
+    st.write(f"**Insight**: {int(risk['engine_overheat'])} readings flagged as engine overheat by the telematics unit.")
+
 # Map Visualization
 st.header("Vehicle Locations")
 if not filtered_df.empty:
-    st.map(filtered_df[['latitude', 'longitude']].dropna())
+    st.map(location_bins(filtered_df), latitude='latitude', longitude='longitude', size='radius', color='color')
 else:
     st.write("No location data available.")
 
@@ -80,65 +318,42 @@ else:
 st.header("Vehicle Metrics Over Time")
 metric_options = ['speed', 'fuel_level', 'engine_temp']
 selected_metric = st.selectbox("Select Metric", metric_options)
-fig_time = px.line(filtered_df, x='timestamp', y=selected_metric, color='vehicle_type',
-                   title=f"{selected_metric.capitalize()} Over Time")
-fig_time.update_layout(xaxis_title="Timestamp", yaxis_title=selected_metric.capitalize())
+fig_time = build_metric_line(filtered_df, filter_key, selected_metric)
 st.plotly_chart(fig_time, use_container_width=True)
 
 # Driver Behavior Analysis
 st.header("Driver Behavior")
 col1, col2 = st.columns(2)
 with col1:
-    driver_state_counts = filtered_df['driver_state'].value_counts().reset_index()
-    driver_state_counts.columns = ['driver_state', 'count']
-    fig_driver = px.bar(driver_state_counts, x='driver_state', y='count',
-                        title="Driver State Distribution",
-                        color='driver_state', color_discrete_sequence=px.colors.qualitative.Plotly)
+    fig_driver = build_state_bar(filtered_df, filter_key)
     st.plotly_chart(fig_driver, use_container_width=True)
 with col2:
-    fig_eye = px.scatter(filtered_df, x='eye_closed_duration', y='driver_state',
-                         color='driver_state', title="Eye Closed Duration vs Driver State",
-                         hover_data=['timestamp', 'vehicle_type'])
-    risky_df = filtered_df[filtered_df['eye_closed_duration'] > 2.5]
-    if not risky_df.empty:
-        fig_eye.add_trace(go.Scatter(x=risky_df['eye_closed_duration'], y=risky_df['driver_state'],
-                                     mode='markers', marker=dict(color='red', size=10, symbol='x'),
-                                     name='Risky (>2.5s)'))
+    fig_eye, risky_count = build_eye_scatter(filtered_df, filter_key)
     st.plotly_chart(fig_eye, use_container_width=True)
-    st.write(f"**Insight**: {len(risky_df)} instances where eye closed duration > 2.5s, indicating potential risk.")
+    st.write(f"**Insight**: {risky_count} instances where eye closed duration > 2.5s, indicating potential risk.")
 
 # Vehicle Health Monitoring
 st.header("Vehicle Health")
 col1, col2 = st.columns(2)
 with col1:
-    health_counts = filtered_df['vehicle_health'].value_counts().reset_index()
-    health_counts.columns = ['vehicle_health', 'count']
-    fig_health = px.pie(health_counts, names='vehicle_health', values='count',
-                        title="Vehicle Health Status")
+    fig_health = build_health_pie(filtered_df, filter_key)
     st.plotly_chart(fig_health, use_container_width=True)
 with col2:
-    fig_temp = px.line(filtered_df, x='timestamp', y='engine_temp', color='vehicle_type',
-                       title="Engine Temperature Over Time")
-    fig_temp.add_hline(y=120, line_dash="dash", line_color="red", annotation_text="Overheating Threshold (120°C)")
-    overheating_count = (filtered_df['engine_temp'] > 120).sum()
+    fig_temp = build_temp_line(filtered_df, filter_key)
     st.plotly_chart(fig_temp, use_container_width=True)
     st.write(f"**Insight**: {overheating_count} instances of engine temperature > 120°C.")
 
 # Accelerometer Insights
 st.header("Accelerometer Readings")
-fig_accel = px.line(filtered_df, x='timestamp', y=['accelerometer_x', 'accelerometer_y', 'accelerometer_z'],
-                    title="Accelerometer Readings Over Time")
-fig_accel.add_hline(y=2.5, line_dash="dash", line_color="orange", annotation_text="High Acceleration Threshold")
-fig_accel.add_hline(y=-2.5, line_dash="dash", line_color="orange")
-high_accel = filtered_df[(filtered_df['accelerometer_x'].abs() > 2.5) |
-                         (filtered_df['accelerometer_y'].abs() > 2.5) |
-                         (filtered_df['accelerometer_z'].abs() > 2.5)]
+fig_accel = build_accel_line(filtered_df, filter_key)
 st.plotly_chart(fig_accel, use_container_width=True)
-st.write(f"**Insight**: {len(high_accel)} high acceleration events detected (|x|, |y|, or |z| > 2.5), indicating potential harsh braking or sharp turns.")
+st.write(f"**Insight**: {high_accel_count} high acceleration events detected (|x|, |y|, or |z| > 2.5), indicating potential harsh braking or sharp turns.")
 
 # Raw Data Table
 st.header("Raw Data")
-st.dataframe(filtered_df)
+with st.expander(f"Show latest {RAW_ROWS} rows", expanded=False):
+    st.dataframe(filtered_df.tail(RAW_ROWS), use_container_width=True)
+st.download_button("Download CSV", export_csv(filtered_df, filter_key), "telematics.csv", "text/csv")
 
 # Footer
 st.markdown("---")